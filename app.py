@@ -1,9 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import os
 import time
+import copy
+from types import MappingProxyType
 from datetime import datetime
-import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import streamlit.components.v1 as components
 from streamlit_gsheets import GSheetsConnection
 
@@ -12,42 +16,53 @@ from streamlit_gsheets import GSheetsConnection
 # ==========================================
 st.set_page_config(page_title="山本塾 計算ドリル", page_icon="✏️", layout="wide")
 
+# orjson が入っていれば、グラフのJSON変換に使う（入っていなければ標準のjsonのまま）
+try:
+    import orjson  # noqa: F401
+    pio.json.config.default_engine = "orjson"
+except ImportError:
+    pass
+
 # 単元とレベルの基本構成・目標タイム・PDFリンクの辞書
-DRILL_DATA = {}
 unit_configs = {
     "たし算": 11,
     "ひき算": 12,
     "かけ算": 8,
     "わり算": 10
 }
+PROBLEMS = ["①", "②", "③", "④"]
 
-for unit, max_lvl in unit_configs.items():
-    DRILL_DATA[unit] = {}
-    for i in range(1, max_lvl + 1):
-        level_name = f"レベル{i}"
-        maru_time = 100 - (i * 2)
-        niju_maru_time = 80 - (i * 2)
-        
-        # 問題①〜④用のPDFリンク（ダミー）を生成
-        pdf_q_dict = {
-            "①": f"https://example.com/{unit}_{level_name}_q1.pdf",
-            "②": f"https://example.com/{unit}_{level_name}_q2.pdf",
-            "③": f"https://example.com/{unit}_{level_name}_q3.pdf",
-            "④": f"https://example.com/{unit}_{level_name}_q4.pdf",
-        }
-        pdf_a_dict = {
-            "①": f"https://example.com/{unit}_{level_name}_a1.pdf",
-            "②": f"https://example.com/{unit}_{level_name}_a2.pdf",
-            "③": f"https://example.com/{unit}_{level_name}_a3.pdf",
-            "④": f"https://example.com/{unit}_{level_name}_a4.pdf",
-        }
-        
-        DRILL_DATA[unit][level_name] = {
-            "maru": maru_time,
-            "niju_maru": niju_maru_time,
-            "pdf_q": pdf_q_dict,
-            "pdf_a": pdf_a_dict
-        }
+# 再実行のたびに作り直さないよう、プロセス内で1度だけ作って使い回す
+# (全セッションで同じものを共有するので、書き換えられないよう読み取り専用にしておく)
+@st.cache_resource
+def _build_drill_data():
+    drill_data = {}
+    for unit, max_lvl in unit_configs.items():
+        levels = {}
+        for i in range(1, max_lvl + 1):
+            level_name = f"レベル{i}"
+            levels[level_name] = MappingProxyType({
+                "maru": 100 - (i * 2),
+                "niju_maru": 80 - (i * 2)
+            })
+        drill_data[unit] = MappingProxyType(levels)
+    return MappingProxyType(drill_data)
+
+DRILL_DATA = _build_drill_data()
+
+# 描画中に何度も引く目標タイムは、(単元, レベル) -> (〇, ◎) の平たい表にしておく
+@st.cache_resource
+def _build_targets():
+    return MappingProxyType({
+        (unit, level): (data["maru"], data["niju_maru"])
+        for unit, levels in DRILL_DATA.items() for level, data in levels.items()
+    })
+
+TARGETS = _build_targets()
+
+# 問題①〜④用のPDFリンク（ダミー）は、実際にボタンを表示するときだけ作る
+def pdf_url(unit, level, kind, p):
+    return f"https://example.com/{unit}_{level}_{kind}{PROBLEMS.index(p) + 1}.pdf"
 
 # ==========================================
 # 2. セッションステートの初期化
@@ -60,7 +75,13 @@ def init_session_state():
     if "selected_level" not in st.session_state:
         st.session_state.selected_level = None
     if "favorites" not in st.session_state:
-        st.session_state.favorites = []
+        # 追加した順番を保ったまま存在チェックできるよう、dictを順序付きの集合として使う
+        st.session_state.favorites = {}
+        # URL (?fav=単元:レベル,...) に残っているお気に入りを復元する
+        for item in st.query_params.get("fav", "").split(","):
+            fav = tuple(item.split(":", 1))
+            if fav in TARGETS and len(st.session_state.favorites) < 3:
+                st.session_state.favorites[fav] = None
     
     if "selected_tab_unit" not in st.session_state:
         st.session_state.selected_tab_unit = "たし算"
@@ -70,12 +91,13 @@ def init_session_state():
         st.session_state.selected_problem = None
         
     # タイマー用
-    if 'start_time' not in st.session_state:
-        st.session_state.start_time = None
     if 'elapsed_time' not in st.session_state:
         st.session_state.elapsed_time = 0.0
-    if 'is_running' not in st.session_state:
-        st.session_state.is_running = False
+    
+    # 保存済みだが、キャッシュ中のデータにはまだ入っていない記録
+    st.session_state.setdefault("_pending_rows", [])
+    # 作成済みのグラフ（(単元, レベル, ミニかどうか) -> (元データ, グラフ)）
+    st.session_state.setdefault("_figs", {})
 
 init_session_state()
 
@@ -89,8 +111,6 @@ def go_to_drill(unit, level):
     # 初期化
     st.session_state.selected_problem = None
     st.session_state.elapsed_time = 0.0
-    st.session_state.start_time = None
-    st.session_state.is_running = False
 
 def go_to_main():
     st.session_state.current_screen = "main"
@@ -99,145 +119,267 @@ def go_to_main():
     st.session_state.selected_problem = None
 
 def toggle_favorite(unit, level):
+    # 変更できたかどうかを返す
     fav = (unit, level)
     if fav in st.session_state.favorites:
-        st.session_state.favorites.remove(fav)
+        del st.session_state.favorites[fav]
     else:
         if len(st.session_state.favorites) >= 3:
             st.warning("お気に入りは最大3つまでです！")
+            return False
         else:
-            st.session_state.favorites.append(fav)
+            st.session_state.favorites[fav] = None
+    
+    # ページを開き直しても残るように、お気に入りをURLにも書いておく
+    if st.session_state.favorites:
+        st.query_params["fav"] = ",".join(f"{u}:{l}" for u, l in st.session_state.favorites)
+    elif "fav" in st.query_params:
+        del st.query_params["fav"]
+    return True
 
 def set_tab_unit(unit):
     st.session_state.selected_tab_unit = unit
 
 def set_problem(p):
     st.session_state.selected_problem = p
+    st.session_state.elapsed_time = 0.0
 
 # ==========================================
 # 4. データ操作関数 (Google Sheets)
 # ==========================================
+COLUMNS = ["日付", "単元", "レベル", "問題", "タイム", "間違えた数"]
+
+# 列の型（単元・レベル・問題はカテゴリ型にして、絞り込みを整数コードの比較で済ませる）
+COLUMN_DTYPES = {
+    "単元": pd.CategoricalDtype(list(unit_configs)),
+    "レベル": pd.CategoricalDtype([f"レベル{i}" for i in range(1, max(unit_configs.values()) + 1)]),
+    "問題": pd.CategoricalDtype(PROBLEMS),
+    "タイム": "float32"
+}
+
+def coerce_columns(df):
+    # 型をそろえる（日付はここで1度だけdatetime64に変換し、以降は文字列として扱わない）
+    df["タイム"] = pd.to_numeric(df["タイム"], errors="coerce")
+    df = df.astype(COLUMN_DTYPES)
+    df["日付"] = pd.to_datetime(df["日付"], format="mixed", errors="coerce")
+    # 間違えた数を数値化（空欄などは0として扱う）
+    df["間違えた数"] = pd.to_numeric(df.get("間違えた数", 0), errors="coerce").fillna(0).astype("int16")
+    return df
+
+@st.cache_resource
 def init_connection():
-    return st.connection("gsheets", type=GSheetsConnection)
+    conn = st.connection("gsheets", type=GSheetsConnection)
+    # シートから読み込んだデータの控え（プロセス内で共有し、次からは増えた行だけを取りに行く）
+    conn._local_cache = {}
+    # 開いたワークシート（開くたびにメタデータの取得が走るので、1度だけ開いて使い回す）
+    conn._worksheet = None
+    return conn
+
+def open_worksheet(conn):
+    if conn._worksheet is None:
+        conn._worksheet = conn.client._open_spreadsheet().worksheet("Sheet1")
+    return conn._worksheet
+
+def _parse_rows(values):
+    # 空行は飛ばし、末尾の空欄は返ってこないので6列にそろえる
+    # (型の変換は、数値でないセルがあっても落ちないよう coerce_columns に任せる)
+    values = [row + [""] * (len(COLUMNS) - len(row)) for row in values if any(row)]
+    return coerce_columns(pd.DataFrame(values, columns=COLUMNS))
+
+def _get_rows(conn, range_name):
+    values = open_worksheet(conn).get(range_name)
+    # 何も無い範囲では [[]] が返るので、空の一覧にそろえる
+    return [] if values == [[]] else values
+
+def _read_full(conn):
+    # 使う6列（A〜F列）を見出しの次の行から1回のリクエストで読み込む
+    # (シートの行数も同じ応答から数えるので、読み込みと数えるあいだに行が増えても食い違わない)
+    rows = _get_rows(conn, "A2:F")
+    return _parse_rows(rows), len(rows), list(rows[-1]) if rows else None
+
+def _read_new_rows(conn, cache):
+    n_rows, last_row = cache["rows"], cache["last_row"]
+    if last_row is None:
+        return _read_full(conn)
+    # 前回の最後の行から下をまとめて取る（1行目は前回の最後の行、2行目以降が増えた行）
+    values = _get_rows(conn, f"A{n_rows + 1}:F")
+    if not values or list(values[0]) != last_row:
+        # 最後の行が変わっていたら（行の削除や途中への挿入など、シートを直接編集された）全件読み直す
+        return _read_full(conn)
+    new_rows = values[1:]
+    if not new_rows:
+        return cache["df"], n_rows, last_row
+    return (
+        pd.concat([cache["df"], _parse_rows(new_rows)], ignore_index=True),
+        n_rows + len(new_rows),
+        list(new_rows[-1])
+    )
 
 @st.cache_data(ttl=60)
 def load_data(_conn):
+    # 読み込みを始めた時刻（これより前に書き込みが済んだ行は、読み込んだデータに入っている）
+    started_at = time.time()
     try:
-        df = _conn.read(worksheet="Sheet1")
-        # カラム構成を最新版に更新
-        expected_columns = ["日付", "単元", "レベル", "問題", "タイム", "間違えた数"]
-        if df.empty or "日付" not in df.columns:
-            return pd.DataFrame(columns=expected_columns)
+        cache = _conn._local_cache
+        if "df" not in cache:
+            df, n_rows, last_row = _read_full(_conn)
+        else:
+            df, n_rows, last_row = _read_new_rows(_conn, cache)
+        # 記録は日付順にそろえておく（ほぼ並んでいるので安定ソートなら速い）
+        df = df.sort_values("日付", kind="mergesort").reset_index(drop=True)
+        # 次の読み込みで続きだけを取れるよう、シートの行数と最後の行も控えておく
+        cache.update(df=df, rows=n_rows, last_row=last_row)
+        # 読み込んだ時刻を残しておき、これより後に保存した行だけを後から足す
+        df.attrs["loaded_at"] = started_at
         return df
     except Exception as e:
         st.error("データの読み込みに失敗しました。")
-        return pd.DataFrame(columns=["日付", "単元", "レベル", "問題", "タイム", "間違えた数"])
+        return coerce_columns(pd.DataFrame(columns=COLUMNS))
+
+def save_data(conn, entry):
+    # シート全体を書き戻さず、保存した1行だけをすぐに末尾へ追記する（失敗したときは例外をそのまま返す）
+    open_worksheet(conn).append_row(
+        [entry["日付"], entry["単元"], entry["レベル"], entry.get("問題", ""), entry["タイム"], entry.get("間違えた数", 0)],
+        value_input_option="USER_ENTERED"
+    )
+    # シートを読み直さずに済むよう、送った行は書き込みが済んだ時刻と一緒に手元にも積んでおく
+    st.session_state._pending_rows.append((time.time(), entry))
+
+def merge_pending_rows(df):
+    # キャッシュを読み込んだ後に保存した行だけを足す（それ以前の行はもうシートから読めている）
+    loaded_at = df.attrs.get("loaded_at", 0.0)
+    pending = [(saved_at, entry) for saved_at, entry in st.session_state._pending_rows if saved_at > loaded_at]
+    st.session_state._pending_rows = pending
+    rows = [entry for _, entry in pending]
+    if not rows:
+        return df
+    # 読み込み元と追加行が前回と同じなら、前回つなげた結果をそのまま使う
+    merged = st.session_state.get("_merged")
+    if merged is not None and merged[0] == loaded_at and merged[1] == rows:
+        return merged[2]
+    new_df = coerce_columns(pd.DataFrame.from_records(rows))
+    merged_df = pd.concat([df, new_df], ignore_index=True)
+    st.session_state._merged = (loaded_at, rows, merged_df)
+    return merged_df
 
-def save_data(conn, df, entry):
-    new_df = pd.concat([df, pd.DataFrame([entry])], ignore_index=True)
-    conn.update(worksheet="Sheet1", data=new_df)
-    st.cache_data.clear()
+# 単元×レベルごとの集計（最高タイム・最終日・回数・直近10回）を1回のgroupbyでまとめて作る
+# (保存や再読み込みのたびに入力が変わるので、古い集計がたまらないよう件数に上限を設ける)
+@st.cache_data(show_spinner=False, max_entries=20)
+def precompute_stats(df):
+    g = df.groupby(["単元", "レベル"], observed=True)
+    # df は読み込み時に日付順にしてあるので、並べ替えずに1回のtailで各レベルの直近10回を取り出す
+    tails = g.tail(10)
+    return {
+        "best": g["タイム"].min().to_dict(),
+        "last": g["日付"].max().to_dict(),
+        "count": g.size().to_dict(),
+        "tails": {k: v for k, v in tails.groupby(["単元", "レベル"], observed=True)}
+    }
 
 # グラフ作成用関数 (間違え数に応じた色変更対応)
-def create_chart(df, unit, level, is_mini=False):
-    filtered_df = df[(df["単元"] == unit) & (df["レベル"] == level)].sort_values("日付").tail(10)
-    if filtered_df.empty:
+def create_chart(stats, unit, level, is_mini=False):
+    key = (unit, level)
+    count = stats["count"].get(key, 0)
+    if count == 0:
         return None
     
-    # 間違えた数を数値化（空欄などは0として扱う）
-    filtered_df["間違えた数"] = pd.to_numeric(filtered_df["間違えた数"], errors='coerce').fillna(0)
+    # (回数, 最終日, 直近10回の中身) をキャッシュのキーにする
+    # (シートを直接直されたときも気づけるよう、グラフに使う列の値からも軽いハッシュを取る)
+    tail = stats["tails"][key]
+    version = (
+        count,
+        stats["last"][key].isoformat(),
+        hash(tuple(tail[c].to_numpy().tobytes() for c in ("日付", "タイム", "間違えた数")))
+    )
     
-    # ドットの色のリストを作成
-    marker_colors = []
-    for mistakes in filtered_df["間違えた数"]:
-        if mistakes == 0:
-            marker_colors.append("blue")
-        elif mistakes == 1:
-            marker_colors.append("orange")
-        else:
-            marker_colors.append("red")
+    # 前回と同じなら、このセッションで作ったグラフをそのまま使う
+    fig_key = (unit, level, is_mini)
+    cached = st.session_state._figs.get(fig_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    maru, niju_maru = TARGETS[key]
+    spec = _build_chart(unit, level, is_mini, version, maru, niju_maru, tail)
+    # st.plotly_chart はdictを受け取ると毎回検証付きでFigureを作り直すので、検証なしでFigureに戻して渡す
+    fig = go.Figure(spec, _validate=False)
+    st.session_state._figs[fig_key] = (version, fig)
+    return fig
+
+# グラフのロックとレイアウト設定（ミニ/通常ごとに共通の部分は1度だけ作っておく）
+_MINI_LAYOUT = dict(
+    dragmode=False,
+    xaxis=dict(showticklabels=False, fixedrange=True),
+    margin=dict(l=0, r=0, t=10, b=0),
+    height=150 # ミニグラフの高さを少し確保
+)
+_FULL_LAYOUT = dict(
+    dragmode=False,
+    xaxis=dict(fixedrange=True),
+    margin=dict(l=0, r=0, t=30, b=0),
+    title="直近10回のタイム推移（青: 満点, オレンジ: 1ミス, 赤: 2ミス以上）",
+    height=400
+)
+
+# データが変わらない限り、同じグラフは作り直さない
+# (キャッシュの保存・復元を軽くするため、Figureではなくdictの形で返す。Figureへの変換は create_chart で行う)
+# (_tail は直近10回分のDataFrame。先頭が _ の引数はキャッシュのキーに使われない)
+# (データが変わるたびに古いグラフが残らないよう、全レベルのミニ/通常の2枚分を目安に上限を設ける)
+@st.cache_data(show_spinner=False, max_entries=100)
+def _build_chart(unit, level, is_mini, version, maru, niju_maru, _tail):
+    dates = _tail["日付"]
+    times = _tail["タイム"].to_numpy()
     
-    targets = DRILL_DATA[unit][level]
-    max_y = max(filtered_df["タイム"].max(), targets["maru"])
+    # ドットの色のリストを作成（0ミス: 青, 1ミス: オレンジ, それ以上: 赤）
+    mistakes = _tail["間違えた数"].to_numpy()
+    marker_colors = np.select([mistakes == 0, mistakes == 1], ["blue", "orange"], default="red")
     
-    # Plotly Graph Objectsでグラフを構築
-    fig = go.Figure()
+    # 数値でないタイム（NaN）は除いて最大値を取る（すべて NaN なら目標タイムに合わせる）
+    max_time = _tail["タイム"].max()
+    max_y = maru if pd.isna(max_time) else max(float(max_time), maru)
+    layout_args = copy.copy(_MINI_LAYOUT if is_mini else _FULL_LAYOUT)
+    layout_args["yaxis"] = dict(range=[0, max_y * 1.1], fixedrange=True)
     
-    # 折れ線とマーカーを追加
+    # 日付の間隔ではなく、挑戦した順に等間隔で並べる（目盛りには日付を出す）
+    x = np.arange(len(times))
+    if not is_mini:
+        layout_args["xaxis"] = dict(layout_args["xaxis"], tickvals=x.tolist(), ticktext=dates.dt.strftime("%m/%d").tolist())
+    
+    # 折れ線とマーカーを追加して、Plotly Graph Objectsでグラフを構築
+    # (大きいグラフはWebGLで描画し、小さいミニグラフはGLの初期化の方が重いのでSVGのまま)
     marker_size = 12 if is_mini else 16 # ドットの大きさを少し大きく
-    fig.add_trace(go.Scatter(
-        x=filtered_df["日付"],
-        y=filtered_df["タイム"],
+    scatter = go.Scatter if is_mini else go.Scattergl
+    fig = go.Figure(data=[scatter(
+        x=x,
+        y=times,
+        hovertext=dates.dt.strftime("%m/%d %H:%M").to_numpy(), # ホバー表示用の日付はサーバー側で整形しておく
+        hoverinfo="text+y",
         mode='lines+markers',
         line=dict(color='lightgray', width=2), # 線の色はグレーで固定
         marker=dict(color=marker_colors, size=marker_size, line=dict(width=1, color='black')),
-        name='タイム'
-    ))
+        name='タイム',
+        _validate=False
+    )], layout=layout_args, _validate=False) # 形の決まったグラフなので、引数の検証は省く
     
     # 目標ライン
-    fig.add_hline(y=targets["maru"], line_dash="dash", line_color="green", 
+    fig.add_hline(y=maru, line_dash="dash", line_color="green", 
                   annotation_text="〇" if not is_mini else "", annotation_position="bottom right")
-    fig.add_hline(y=targets["niju_maru"], line_dash="dash", line_color="blue", 
+    fig.add_hline(y=niju_maru, line_dash="dash", line_color="blue", 
                   annotation_text="◎" if not is_mini else "", annotation_position="bottom right")
     
-    # グラフのロックとレイアウト設定
-    layout_args = dict(
-        dragmode=False,
-        yaxis=dict(range=[0, max_y * 1.1], fixedrange=True),
-        xaxis=dict(type='category', fixedrange=True),
-        margin=dict(l=0, r=0, t=30 if not is_mini else 10, b=0)
-    )
-    
-    if is_mini:
-        layout_args.update(dict(
-            xaxis_title=None, yaxis_title=None,
-            xaxis=dict(showticklabels=False, type='category', fixedrange=True),
-            height=150 # ミニグラフの高さを少し確保
-        ))
-    else:
-        layout_args.update(dict(
-            title="直近10回のタイム推移（青: 満点, オレンジ: 1ミス, 赤: 2ミス以上）",
-            height=400
-        ))
-        
-    fig.update_layout(**layout_args)
-    return fig
+    return fig.to_dict()
 
 # ==========================================
 # 5. UIコンポーネント：メイン画面
 # ==========================================
-def display_main_screen(df):
-    st.title("📚 山本塾 計算ドリル")
-    
-    if st.button("🔄 データを最新に更新", use_container_width=False):
-        st.cache_data.clear()
-        st.rerun()
-
-    st.markdown("---")
-
-    # ----- お気に入り（挑戦中）セクション -----
-    st.subheader("🌟 現在挑戦中のレベル")
-    if not st.session_state.favorites:
-        st.info("下のリストから、挑戦したいレベルの「⭐」を押して追加しよう！")
-    else:
-        cols = st.columns(3)
-        for i, (f_unit, f_level) in enumerate(st.session_state.favorites):
-            with cols[i]:
-                with st.container(border=True):
-                    st.markdown(f"### {f_unit} : {f_level}")
-                    
-                    fig = create_chart(df, f_unit, f_level, is_mini=True)
-                    if fig:
-                        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"fav_chart_{f_unit}_{f_level}")
-                    else:
-                        st.write("まだ記録がありません")
-                    
-                    st.button("🔥 挑戦する！", key=f"fav_btn_{f_unit}_{f_level}", type="primary", use_container_width=True, on_click=go_to_drill, args=(f_unit, f_level))
-                    st.button("❌ はずす", key=f"rem_btn_{f_unit}_{f_level}", use_container_width=True, on_click=toggle_favorite, args=(f_unit, f_level))
-
-    st.markdown("---")
+# レベルカードの列の比率（左: 情報とボタン, 右: グラフ。右側のグラフの幅を少し広めに）
+_CARD_COLS = [1, 1.2]
+# カード内のボタン列（お気に入り / 挑戦）
+_ACTION_COLS = [1, 1]
 
-    # ----- 全レベル一覧 -----
+# ドリル一覧はフラグメントにして、単元タブの切り替えではこの部分だけを再実行する
+# (お気に入り欄のグラフやデータの読み込みをやり直さないため)
+@st.fragment
+def _level_list(stats):
     st.subheader("📖 ドリル一覧")
     
     units = list(unit_configs.keys())
@@ -248,20 +390,24 @@ def display_main_screen(df):
             st.button(u, key=f"tab_{u}", type=btn_type, use_container_width=True, on_click=set_tab_unit, args=(u,))
     
     current_unit = st.session_state.selected_tab_unit
+    # ループの中で毎回 session_state を引かないよう、先に取り出しておく
+    favorites = st.session_state.favorites
     st.markdown("<br>", unsafe_allow_html=True)
     
     # 選択された単元のレベルを一覧表示
-    for level, data in DRILL_DATA[current_unit].items():
+    for level in DRILL_DATA[current_unit]:
         with st.container(border=True):
             # --- 左右に分割（左: 情報とボタン, 右: グラフ） ---
-            col_left, col_right = st.columns([1, 1.2]) # 右側のグラフの幅を少し広めに
+            col_left, col_right = st.columns(_CARD_COLS)
             
             # データの集計
-            filtered_df = df[(df["単元"] == current_unit) & (df["レベル"] == level)]
-            if not filtered_df.empty:
-                best_time = f"{filtered_df['タイム'].min():.1f} 秒"
-                last_date = filtered_df["日付"].max()
-                try_count = f"{len(filtered_df)} 回"
+            key = (current_unit, level)
+            maru, niju_maru = TARGETS[key]
+            if key in stats["count"]:
+                best_time = f"{stats['best'][key]:.1f} 秒"
+                last = stats["last"][key]
+                last_date = last.strftime("%Y-%m-%d") if pd.notna(last) else "-"
+                try_count = f"{stats['count'][key]} 回"
             else:
                 best_time = "-"
                 last_date = "-"
@@ -270,124 +416,95 @@ def display_main_screen(df):
             # 左側：文字情報とボタン
             with col_left:
                 st.markdown(f"### {level}")
-                st.markdown(f"**🎯 目標** 〇: {data['maru']}秒 / ◎: {data['niju_maru']}秒")
+                st.markdown(f"**🎯 目標** 〇: {maru}秒 / ◎: {niju_maru}秒")
                 st.markdown(f"**🏆 最高:** {best_time}  \n**📅 最終:** {last_date}  \n**🔄 回数:** {try_count}")
                 
                 st.markdown("<br>", unsafe_allow_html=True)
-                btn_col1, btn_col2 = st.columns(2)
+                btn_col1, btn_col2 = st.columns(_ACTION_COLS)
                 with btn_col1:
-                    is_fav = (current_unit, level) in st.session_state.favorites
+                    is_fav = key in favorites
                     fav_icon = "⭐ 解除" if is_fav else "☆ 追加"
-                    st.button(fav_icon, key=f"list_fav_{current_unit}_{level}", on_click=toggle_favorite, args=(current_unit, level), use_container_width=True)
+                    # お気に入り欄はフラグメントの外にあるので、変えたときは画面全体を再実行する
+                    if st.button(fav_icon, key=f"list_fav_{current_unit}_{level}", use_container_width=True):
+                        if toggle_favorite(current_unit, level):
+                            st.rerun()
                 with btn_col2:
-                    st.button("▶️ 挑戦！", key=f"list_chal_{current_unit}_{level}", type="primary", on_click=go_to_drill, args=(current_unit, level), use_container_width=True)
+                    if st.button("▶️ 挑戦！", key=f"list_chal_{current_unit}_{level}", type="primary", use_container_width=True):
+                        go_to_drill(current_unit, level)
+                        st.rerun()
             
             # 右側：グラフ
             with col_right:
-                fig = create_chart(df, current_unit, level, is_mini=True)
-                if fig:
-                    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"list_chart_{current_unit}_{level}")
-                else:
+                # 記録がないレベルはグラフを作らない
+                if stats["count"].get(key, 0) == 0:
                     # グラフがない場合は余白を埋めるために少し改行
                     st.markdown("<br><br>", unsafe_allow_html=True)
                     st.info("まだ記録がありません")
+                else:
+                    fig = create_chart(stats, current_unit, level, is_mini=True)
+                    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"list_chart_{current_unit}_{level}")
 
-# ==========================================
-# 6. UIコンポーネント：ドリル実行画面
-# ==========================================
-def display_drill_screen(conn, df):
-    unit = st.session_state.selected_unit
-    level = st.session_state.selected_level
-    data = DRILL_DATA[unit][level]
-    
-    st.button("⬅️ 一覧に戻る", on_click=go_to_main)
-    st.title(f"🔥 {unit} {level} に挑戦！")
+def display_main_screen(stats):
+    st.title("📚 山本塾 計算ドリル")
     
-    col_tgt1, col_tgt2 = st.columns(2)
-    col_tgt1.info(f"🎯 目標タイム 〇: {data['maru']} 秒")
-    col_tgt2.info(f"🎯 目標タイム ◎: {data['niju_maru']} 秒")
+    if st.button("🔄 データを最新に更新", use_container_width=False):
+        st.cache_data.clear()
+        init_connection()._local_cache.clear()
+        st.session_state._figs.clear()
+        st.rerun()
 
     st.markdown("---")
-    
-    # ----- 挑戦する問題（①〜④）の選択 -----
-    st.markdown("### 1️⃣ どの問題に挑戦する？")
-    p_cols = st.columns(4)
-    problems = ["①", "②", "③", "④"]
-    
-    for i, p in enumerate(problems):
-        with p_cols[i]:
-            btn_type = "primary" if st.session_state.selected_problem == p else "secondary"
-            st.button(f"問題{p} に挑戦", key=f"prob_{p}", type=btn_type, use_container_width=True, on_click=set_problem, args=(p,))
 
-    if not st.session_state.selected_problem:
-        st.warning("👆 上のボタンから、挑戦する問題（①〜④）を選んでね！")
-        return # 問題が選ばれるまではこれ以降のUIを表示しない
-        
-    p = st.session_state.selected_problem
-    
-    # 選択された問題のPDFリンクを表示
-    st.link_button(f"📄 問題{p} のプリントを開く (印刷・表示)", data["pdf_q"][p], use_container_width=True)
-    
+    # ----- お気に入り（挑戦中）セクション -----
+    st.subheader("🌟 現在挑戦中のレベル")
+    if not st.session_state.favorites:
+        st.info("下のリストから、挑戦したいレベルの「⭐」を押して追加しよう！")
+    else:
+        cols = st.columns(3)
+        for i, (f_unit, f_level) in enumerate(st.session_state.favorites):
+            with cols[i]:
+                with st.container(border=True):
+                    st.markdown(f"### {f_unit} : {f_level}")
+                    
+                    # 記録がないレベルはグラフを作らない
+                    if stats["count"].get((f_unit, f_level), 0) == 0:
+                        st.write("まだ記録がありません")
+                    else:
+                        fig = create_chart(stats, f_unit, f_level, is_mini=True)
+                        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"fav_chart_{f_unit}_{f_level}")
+                    
+                    st.button("🔥 挑戦する！", key=f"fav_btn_{f_unit}_{f_level}", type="primary", use_container_width=True, on_click=go_to_drill, args=(f_unit, f_level))
+                    st.button("❌ はずす", key=f"rem_btn_{f_unit}_{f_level}", use_container_width=True, on_click=toggle_favorite, args=(f_unit, f_level))
+
     st.markdown("---")
 
-    # ----- タイマー機能 -----
+    # ----- 全レベル一覧（単元の切り替えはこの部分だけを再実行する） -----
+    _level_list(stats)
+
+# ==========================================
+# 6. UIコンポーネント：ドリル実行画面
+# ==========================================
+# ストップウォッチ（stopwatch/index.html）
+_stopwatch = components.declare_component("stopwatch", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwatch"))
+
+# タイマー部分はフラグメントにして、計測結果を受け取ったときはこの部分だけを再実行する
+# (グラフなど画面全体の再描画をしないため)
+@st.fragment
+def _timer_ui(conn, unit, level, p):
     st.subheader(f"⏱️ 2️⃣ ストップウォッチ (問題{p})")
-    countdown_placeholder = st.empty()
-
-    t_col1, t_col2, t_col3 = st.columns(3)
-    with t_col1:
-        if st.button("▶️ 開始", use_container_width=True):
-            for i in range(3, 0, -1):
-                countdown_placeholder.markdown(f"<h1 style='text-align: center; font-size: 80px;'>{i}</h1>", unsafe_allow_html=True)
-                time.sleep(1)
-            countdown_placeholder.markdown("<h1 style='text-align: center; font-size: 80px; color: red;'>スタート！</h1>", unsafe_allow_html=True)
-            time.sleep(0.5)
-            countdown_placeholder.empty()
-            
-            st.session_state.start_time = time.time()
-            st.session_state.is_running = True
-            st.session_state.elapsed_time = 0.0
-            st.rerun()
-
-    with t_col2:
-        if st.button("⏹️ 停止", use_container_width=True) and st.session_state.is_running:
-            st.session_state.elapsed_time = time.time() - st.session_state.start_time
-            st.session_state.is_running = False
-            st.rerun()
-
-    with t_col3:
-        if st.button("🔄 リセット", use_container_width=True):
-            st.session_state.start_time = None
-            st.session_state.elapsed_time = 0.0
-            st.session_state.is_running = False
-            st.rerun()
-
-    if st.session_state.is_running:
-        st.warning("計測中... (画面上の「停止」を押すか、スペースキーを押してください)")
-        components.html(
-            """
-            <script>
-            const doc = window.parent.document;
-            doc.addEventListener('keydown', function(e) {
-                if (e.code === 'Space') {
-                    e.preventDefault();
-                    const buttons = Array.from(doc.querySelectorAll('button'));
-                    const stopBtn = buttons.find(el => el.innerText.includes('停止'));
-                    if (stopBtn) { stopBtn.click(); }
-                }
-            });
-            </script>
-            """, height=0
-        )
+    # カウントダウンと計測はブラウザ側で行い、停止したときの結果（ミリ秒）だけを受け取る
+    elapsed_ms = _stopwatch(key=f"stopwatch_{unit}_{level}_{p}", default=None)
+    if elapsed_ms is not None:
+        st.session_state.elapsed_time = elapsed_ms / 1000
     
     # ----- 計測完了後の処理（解答確認＆保存） -----
-    if st.session_state.elapsed_time > 0 and not st.session_state.is_running:
+    if st.session_state.elapsed_time > 0:
         st.success(f"🎉 計測完了: {st.session_state.elapsed_time:.1f} 秒")
         st.markdown("---")
         st.subheader("📝 3️⃣ 丸つけと記録")
         
         # 選択された問題の解答PDF
-        st.link_button(f"✅ 解答プリントを開く (問題{p}の丸つけ)", data["pdf_a"][p], use_container_width=True)
+        st.link_button(f"✅ 解答プリントを開く (問題{p}の丸つけ)", pdf_url(unit, level, "a", p), use_container_width=True)
         
         st.write("▼ タイムと間違えた数を確認して保存しよう！")
         
@@ -401,39 +518,81 @@ def display_drill_screen(conn, df):
         if st.button("💾 記録を保存して戻る", type="primary", use_container_width=True):
             if input_time > 0:
                 entry = {
-                    "日付": datetime.now().strftime("%Y-%m-%d"),
+                    "日付": datetime.now().isoformat(timespec="seconds"),
                     "単元": unit,
                     "レベル": level,
                     "問題": p,         # 新規追加列
                     "タイム": input_time,
                     "間違えた数": input_mistakes # 新規追加列
                 }
-                save_data(conn, df, entry)
-                st.success("保存しました！")
-                time.sleep(1)
-                go_to_main()
-                st.rerun()
-                
+                try:
+                    save_data(conn, entry)
+                except Exception:
+                    st.error("保存に失敗しました。通信を確認して、もう一度保存してください。")
+                else:
+                    st.success("保存しました！")
+                    time.sleep(1)
+                    go_to_main()
+                    st.rerun()
+
+def display_drill_screen(conn, stats):
+    unit = st.session_state.selected_unit
+    level = st.session_state.selected_level
+    maru, niju_maru = TARGETS[(unit, level)]
+    
+    st.button("⬅️ 一覧に戻る", on_click=go_to_main)
+    st.title(f"🔥 {unit} {level} に挑戦！")
+    
+    col_tgt1, col_tgt2 = st.columns(2)
+    col_tgt1.info(f"🎯 目標タイム 〇: {maru} 秒")
+    col_tgt2.info(f"🎯 目標タイム ◎: {niju_maru} 秒")
+
+    st.markdown("---")
+    
+    # ----- 挑戦する問題（①〜④）の選択 -----
+    st.markdown("### 1️⃣ どの問題に挑戦する？")
+    p_cols = st.columns(4)
+    for i, p in enumerate(PROBLEMS):
+        with p_cols[i]:
+            btn_type = "primary" if st.session_state.selected_problem == p else "secondary"
+            st.button(f"問題{p} に挑戦", key=f"prob_{p}", type=btn_type, use_container_width=True, on_click=set_problem, args=(p,))
+
+    if not st.session_state.selected_problem:
+        st.warning("👆 上のボタンから、挑戦する問題（①〜④）を選んでね！")
+        return # 問題が選ばれるまではこれ以降のUIを表示しない
+        
+    p = st.session_state.selected_problem
+    
+    # 選択された問題のPDFリンクを表示
+    st.link_button(f"📄 問題{p} のプリントを開く (印刷・表示)", pdf_url(unit, level, "q", p), use_container_width=True)
+    
+    st.markdown("---")
+
+    # ----- タイマー機能（ここだけを再実行する） -----
+    _timer_ui(conn, unit, level, p)
+
     # ----- 挑戦画面の大きなグラフ表示 -----
     st.markdown("---")
     st.subheader("📊 これまでの推移")
-    fig = create_chart(df, unit, level, is_mini=False)
-    if fig:
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"drill_chart_{unit}_{level}")
-    else:
+    if stats["count"].get((unit, level), 0) == 0:
         st.info("まだ記録がありません。最初の記録を作りましょう！")
+    else:
+        fig = create_chart(stats, unit, level, is_mini=False)
+        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"drill_chart_{unit}_{level}")
 
 # ==========================================
 # 7. メイン処理 (画面のルーティング)
 # ==========================================
 def main():
     conn = init_connection()
-    df = load_data(conn)
+    df = merge_pending_rows(load_data(conn))
+    # 集計はデータが変わったときだけ作り直す
+    stats = precompute_stats(df)
     
     if st.session_state.current_screen == "main":
-        display_main_screen(df)
+        display_main_screen(stats)
     elif st.session_state.current_screen == "drill":
-        display_drill_screen(conn, df)
+        display_drill_screen(conn, stats)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file